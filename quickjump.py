@@ -22,18 +22,21 @@ Author: Laszlo Szathmary, jabba.laci@gmail.com, 2019--2024
 GitHub: https://github.com/jabbalaci/quickjump
 """
 
-import hashlib
-import json
+import bisect
 import os
-import random
-import readline  # noqa
 import sys
+from typing import Callable
 
 VERSION = "0.2.4"
 
 NOT_FOUND, FOUND = range(2)
 HOME = os.path.expanduser("~")
 DB_FILE = f"{HOME}/Dropbox/quickjump.json"
+# hash -> directory map (a GNU dbm file), it's regenerated automatically from DB_FILE;
+# it's a local cache, don't put it in a synced folder
+REV_FILE = f"{HOME}/.cache/quickjump/quickjump.rev.gdbm"
+# key in REV_FILE that holds the mtime of DB_FILE; it can't be a hash since it contains a "/"
+REV_MTIME_KEY = "/mtime"
 # DEFAULT_EDITOR = "code"  # VS Code
 DEFAULT_EDITOR = os.getenv("EDITOR")
 
@@ -43,36 +46,49 @@ if not DEFAULT_EDITOR:
 
 
 def LD(s: str, t: str) -> int:
-    """Levenshtein distance"""
-    s = " " + s
-    t = " " + t
-    d = {}
-    S = len(s)
-    T = len(t)
-    for i in range(S):
-        d[i, 0] = i
-    for j in range(T):
-        d[0, j] = j
-    for j in range(1, T):
-        for i in range(1, S):
-            if s[i] == t[j]:
-                d[i, j] = d[i - 1, j - 1]
+    """
+    Levenshtein distance.
+    Only the previous row of the DP table is kept, thus no (i, j) dict is needed.
+    The common prefix and suffix don't change the distance, so they are cut off first.
+    """
+    while s and t and s[0] == t[0]:
+        s, t = s[1:], t[1:]
+    while s and t and s[-1] == t[-1]:
+        s, t = s[:-1], t[:-1]
+    if len(s) < len(t):
+        s, t = t, s  # the rows are as short as possible
+    if not t:
+        return len(s)
+    # else
+    prev = list(range(len(t) + 1))
+    for i, c in enumerate(s, start=1):
+        curr = [i]
+        for j, d in enumerate(t, start=1):
+            if c == d:
+                curr.append(prev[j - 1])
             else:
-                d[i, j] = min(d[i - 1, j] + 1, d[i, j - 1] + 1, d[i - 1, j - 1] + 1)
-    return d[S - 1, T - 1]
+                curr.append(min(prev[j], curr[j - 1], prev[j - 1]) + 1)
+        #
+        prev = curr
+    #
+    return prev[-1]
 
 
 def verify_db(db: dict[str, str]) -> None:
     """
     Both the keys (directory names) and the values (hashes) must be unique.
     However, if you edit the bookmarks manually, uniqueness may break.
-    So let's check it.
+    So let's check it. The keys are unique in a dict, thus only the values are checked.
     """
-    d2 = {v: k for k, v in db.items()}
-    if len(db) != len(d2):
-        print("Error: directory names and hashes must be unique in the database.")
-        print("Hint: there is a duplicate somewhere.")
-        exit(1)
+    seen: set[str] = set()
+    for v in db.values():
+        if v in seen:
+            print("Error: directory names and hashes must be unique in the database.")
+            print(f"Hint: the hash '{v}' is a duplicate.")
+            exit(1)
+        #
+        seen.add(v)
+    #
 
 
 def read_db(fname: str) -> dict[str, str]:
@@ -91,11 +107,33 @@ def read_db(fname: str) -> dict[str, str]:
             print("# Error: the database file couldn't be created. Aborting.")
             exit(1)
         #
+    # The parser is imported here since a jump with a fresh cache doesn't read the database.
+    # orjson is optional, the standard json module is used if it's not installed.
+    # A syntax error raises a ValueError (json.JSONDecodeError / orjson.JSONDecodeError).
     try:
+        import orjson
+    except ImportError:
+        import json
+
         with open(fname) as f:
             db = json.load(f)
-    except:
-        raise
+    else:
+        import mmap
+
+        with open(fname, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                db = orjson.loads(f.read())  # an empty file can't be memory-mapped
+            else:
+                # orjson can parse the memory-mapped file directly, no copy is made
+                with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+                    with memoryview(mm) as view:
+                        db = orjson.loads(view)
+            #
+        #
+    #
+    if not isinstance(db, dict):
+        print("Error: the database must be a JSON object (directory name / hash pairs).")
+        exit(1)
     #
     verify_db(db)
     return db
@@ -123,46 +161,118 @@ def save_db(fname: str, db: dict[str, str]) -> bool:
     """
     Save changes in the database.
     """
+    import json  # imported here since it's needed only when the database changes
+
     db = simplify_db(db)
     status = True
     try:
-        with open(fname, "w") as f:
+        # json.dump() writes the encoded chunks one by one, the whole text isn't built in memory
+        with open(fname, "w", buffering=64 * 1024) as f:
             json.dump(db, f, indent=4)
-    except:
+            f.flush()
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+    except OSError as e:
         status = False
-        print(f"Warning! The database couldn't be saved to {DB_FILE}")
+        print(f"Warning! The database couldn't be saved to {fname} ({e.strerror})")
+    else:
+        save_rev_db(invert_db(db), mtime)
     #
     return status
 
 
-def shuffled(lst: list[str]) -> list[str]:
+def invert_db(db: dict[str, str]) -> dict[str, str]:
+    """
+    Turn the database (directory name -> hash) into a hash -> directory name map.
+    The JSON file keeps the directory names as keys since it's edited manually.
     """
-    Return a shuffled copy of the input list. The input list is not modified.
+    return {v: k for k, v in db.items()}
+
+
+def db_mtime() -> int | None:
     """
-    copy = lst[:]
-    random.shuffle(copy)
-    return copy
+    Return the modification time of the database (in nanoseconds), or None if it doesn't exist.
+    """
+    try:
+        return os.stat(DB_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def save_rev_db(d2: dict[str, str], mtime: int) -> None:
+    """
+    Save the inverted database (hash -> directory name) in a GNU dbm file.
+    With this, a jump is a single key lookup, the JSON file isn't parsed at all.
+    mtime is the modification time of the database that d2 was made from,
+    it's stored too to detect if the cache is stale.
+    It's just a cache, thus it's not a problem if it can't be written
+    (or if dbm.gnu is not available).
+    """
+    try:
+        import dbm.gnu
+    except ImportError:
+        return
+    # else
+    try:
+        os.makedirs(os.path.dirname(REV_FILE), exist_ok=True)
+        with dbm.gnu.open(REV_FILE, "n") as rev:
+            for k, v in d2.items():
+                rev[k] = v
+            #
+            rev[REV_MTIME_KEY] = str(mtime)
+    except (OSError, dbm.gnu.error):
+        pass
 
 
-def string_to_md5(content: str) -> str:
+def read_rev_db(my_hash: str) -> tuple[bool, str | None]:
     """
-    Take a string and calculate its md5 hash (as a string).
+    Look up a hash in the inverted database (hash -> directory name).
+    Return a (fresh, directory name) pair. If the cache is missing, unavailable or
+    stale (e.g. the JSON file was edited manually or it was updated by Dropbox),
+    then fresh is False. If the hash is not in a fresh cache, the directory name is None.
     """
-    encoded = content.encode("utf8")
-    return hashlib.md5(encoded).hexdigest()
+    try:
+        import dbm.gnu
+    except ImportError:
+        return False, None
+    # else
+    try:
+        with dbm.gnu.open(REV_FILE, "r") as rev:
+            if REV_MTIME_KEY not in rev or rev[REV_MTIME_KEY] != str(db_mtime()).encode():
+                return False, None
+            # else
+            if my_hash not in rev:
+                return True, None
+            # else
+            return True, rev[my_hash].decode("utf8")
+    except (OSError, dbm.gnu.error):
+        return False, None
+
+
+def bytes_to_hash(data: bytes, salt: int = 0) -> str:
+    """
+    Calculate a short hash of the data (as a hex string).
+    Only the first 3 characters are used, so a 2 bytes long BLAKE2b digest is enough.
+    Python's built-in hash() can't be used since it changes from run to run.
+    BLAKE2b supports a salt natively, thus different hashes of the same data
+    can be created without modifying the data (salt 0 is the same as no salt).
+    """
+    import hashlib  # imported here since it's needed only when a bookmark is created
+
+    return hashlib.blake2b(data, digest_size=2, salt=salt.to_bytes(16, "little")).hexdigest()
 
 
 def generate_hash(db: dict[str, str]) -> str:
     """
     Create a unique 3 characters long hash for the current directory.
+    In case of a collision, the directory name is hashed again with an increasing salt.
     """
-    cwd = os.getcwd()
-    full_hash = string_to_md5(cwd)
-    my_hash = full_hash[:3]
-    while my_hash in db.values():
-        lst = shuffled(list(full_hash))
-        new_full_hash = "".join(lst)
-        my_hash = new_full_hash[:3]
+    cwd = os.getcwd().encode("utf8")
+    existing = set(db.values())
+    my_hash = bytes_to_hash(cwd)[:3]
+    i = 0
+    while my_hash in existing:
+        i += 1
+        my_hash = bytes_to_hash(cwd, salt=i)[:3]
     # endwhile
     return my_hash
 
@@ -170,23 +280,26 @@ def generate_hash(db: dict[str, str]) -> str:
 def list_db(db: dict[str, str], file=sys.stdout) -> None:
     """
     List the content of the database in a readable format.
+    The output is built first and then written out at once.
     """
     if len(db) == 0:
         return
     # else
-    longest = max(len(v) for v in db.values())
-    for k, v in db.items():
-        extra_spaces = " " * (longest - len(v))
-        print(f"{v}{extra_spaces}  ->  {k}", file=file)
+    longest = max(map(len, db.values()))
+    lines = [f"{v:<{longest}}  ->  {k}" for k, v in db.items()]
+    if file == sys.stdout:
+        lines.append("-" * 78)
     #
-    if db and file == sys.stdout:
-        print("-" * 78, file=file)
+    file.write("\n".join(lines) + "\n")
 
 
 def go_interactive() -> None:
     """
     If you launch the program without any command-line parameters.
     """
+    # line editing for input(); imported here since it's not needed when jumping
+    import readline  # noqa
+
     db = read_db(DB_FILE)
     list_db(db)
     print(
@@ -233,8 +346,10 @@ def go_interactive() -> None:
         elif inp in ("3", "v"):
             try:
                 read_db(DB_FILE)
-            except:
+            except ValueError:
                 print("Error: The database file has a syntax error.")
+            except SystemExit:
+                pass  # read_db() has already printed the problem, stay in the menu
             else:
                 print("The database file looks good.")
         else:
@@ -256,9 +371,35 @@ def expand_home(path: str) -> str:
     return path
 
 
-def find_similar_words(word: str, words: list[str]) -> list[str]:
-    result: list[str] = sorted(words, key=lambda w: LD(word, w))
-    return result
+def find_similar_words(word: str, words: list[str], limit: int = 3) -> list[str]:
+    """
+    Return the `limit` words that are the closest to `word` (Levenshtein distance).
+    In case of a tie, the word that comes first in `words` wins.
+    The difference of the lengths is a lower bound of the distance, so the candidates
+    are visited in that order and we stop when no remaining word can get in the top list.
+    """
+    # rapidfuzz is optional, its C++ implementation is much faster than LD();
+    # it's imported here since it's needed only if a bookmark wasn't found
+    distance: Callable[[str, str], int] = LD
+    try:
+        from rapidfuzz.distance import Levenshtein
+    except ImportError:
+        pass
+    else:
+        distance = Levenshtein.distance
+    #
+    if limit <= 0:
+        return []
+    # else
+    candidates = sorted(enumerate(words), key=lambda p: abs(len(p[1]) - len(word)))
+    top: list[tuple[int, int, str]] = []  # (distance, position in words, word)
+    for i, w in candidates:
+        if len(top) == limit and abs(len(w) - len(word)) > top[-1][0]:
+            break
+        bisect.insort(top, (distance(word, w), i, w))
+        del top[limit:]
+    #
+    return [w for _, _, w in top]
 
 
 def find_directory(my_hash: str) -> tuple[str, int]:
@@ -269,17 +410,23 @@ def find_directory(my_hash: str) -> tuple[str, int]:
     If not found, it returns the path of the current directory and the NOT_FOUND error code.
     """
     my_hash = my_hash.split("/")[0]
-    db = read_db(DB_FILE)
-    d2 = {v: k for k, v in db.items()}
-    err_code = FOUND
+    fresh, dname = read_rev_db(my_hash)
+    if dname is not None:
+        return expand_home(dname), FOUND
+    # else, the cache is stale or the hash is unknown: use the database
+    mtime = db_mtime()  # taken before reading, so a newer file makes the cache stale
+    d2 = invert_db(read_db(DB_FILE))
+    if not fresh and mtime is not None:
+        save_rev_db(d2, mtime)
     #
-    if my_hash not in d2:
+    dname = d2.get(my_hash)
+    if dname is None:
         print("# no such bookmark", file=sys.stderr)
-        tips = find_similar_words(my_hash, list(d2.keys()))[:3]
+        tips = find_similar_words(my_hash, list(d2.keys()), limit=3)
         print("# similar bookmarks: {0}".format(", ".join(tips)), file=sys.stderr)
-        err_code = NOT_FOUND
-    #
-    return expand_home(d2.get(my_hash, os.getcwd())), err_code
+        return os.getcwd(), NOT_FOUND
+    # else
+    return expand_home(dname), FOUND
 
 
 def print_help(file=sys.stderr) -> None:
@@ -299,10 +446,15 @@ Provide an alias or use one of these options:
 def create_tmp_send() -> None:
     """
     Create /tmp/send silently.
+    It's called on every run and the directory exists almost always,
+    so check it first instead of letting mkdir() fail.
     """
+    if os.path.isdir("/tmp/send"):
+        return
+    # else
     try:
-        os.mkdir("/tmp/send")
-    except:
+        os.makedirs("/tmp/send", exist_ok=True)
+    except OSError:
         pass
 
 
@@ -310,17 +462,38 @@ def clean(s: str) -> str:
     return s.removesuffix("/")
 
 
+def is_dir(entry: os.DirEntry) -> bool:
+    """
+    Like os.path.isdir(): an entry that can't be checked (e.g. a symlink loop
+    or a symlink into a directory that can't be searched) is not a directory.
+    """
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+def list_subdirs(path: str) -> list[str]:
+    """
+    Return the sorted names of the subdirectories of path.
+    """
+    # DirEntry.is_dir() uses the file type from the directory listing,
+    # only symlinks need an extra stat() call
+    with os.scandir(path) as it:
+        return sorted(e.name for e in it if is_dir(e))
+
+
 def find_destination_directory(dname: str, parts: list[str]) -> str:
     result = dname
     for part in parts:
-        dirs = sorted([e for e in os.listdir(result) if os.path.isdir(os.path.join(result, e))])
-        for _dir in dirs:
-            if _dir.startswith(part):
-                result = os.path.join(result, _dir)
-                break
-            #
-        else:  # nobreak
-            # if nothing was found: break out of the outer loop
+        dirs = list_subdirs(result)
+        # dirs is sorted, thus the first name with the given prefix
+        # (if there is any) is at the insertion point of the prefix
+        idx = bisect.bisect_left(dirs, part)
+        if idx < len(dirs) and dirs[idx].startswith(part):
+            result = os.path.join(result, dirs[idx])
+        else:
+            # if nothing was found: break out of the loop
             break
         #
     #